@@ -24,6 +24,7 @@ from bmo.cmds.cmd_parser import bmo_parser
 from bmo.devices.tcc_device import TCCDevice
 from bmo.devices.manta import MantaCameraSet
 from bmo.logger import log
+from bmo.utils import prefetch_plate_data
 
 
 LCOTCC_HOST = '10.1.1.20'
@@ -129,5 +130,8 @@ class BMOActor(BaseActor):
 
         log.info('detected new plate {}. Showing charts.'.format(plate_id), self)
 
+        for error in prefetch_plate_data(plate_id):
+            log.warning('failed to prefetch plate data: {0}'.format(error), self)
+
         cmd_chart = UserCmd(cmdStr='ds9 show_chart {0}'.format(plate_id))
         self.parseAndDispatchCmd(cmd_chart)
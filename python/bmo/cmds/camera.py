@@ -16,37 +16,57 @@ import os
 import astropy.io.fits
 import click
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, threads
 
 from bmo.cmds import bmo_context
 from bmo.logger import log
 
-from bmo.utils import show_in_ds9, get_sjd, get_camera_coordinates
+from bmo.utils import display_in_ds9, measure_centroid, get_sjd, get_camera_coordinates
 
 __all__ = ['camera']
 
 
-def display_image(image, camera_type, actor, cmd):
-    """Displays image in DS9 and gets centroids."""
+# The last exposure number assigned in each directory. Images are written in a
+# thread so we cannot rely only on the files already on disk.
+_last_exposure_no = {}
+
+# How often (in frames) to measure the FWHM. Can be overridden by the actor configuration.
+FWHM_CADENCE = 1
+
+# Number of frames displayed for each camera, used to determine when to measure the FWHM.
+_n_frames_displayed = {'on': 0, 'off': 0}
+
+# The deferred chain processing the frames of each camera. New frames are
+# processed only after the previous one has been displayed and saved.
+_processing = {'on': None, 'off': None}
+
+
+def display_image(image, centroid, camera_type, actor, cmd):
+    """Displays image and centroid in DS9 and outputs the centroid."""
 
     frame = 1 if camera_type == 'on' else 3
 
     try:
-        centroid = show_in_ds9(image, frame=frame, ds9=actor.ds9)
+        display_in_ds9(image, centroid=centroid, frame=frame, ds9=actor.ds9)
     except Exception as ee:
         log.warning('failed to show image in DS9: {0}'.format(ee), actor)
-        return False
 
     if not centroid:
         actor.writeToUsers('i', 'text="no centroid detected for '
                                 '{0}-axis camera."'.format(camera_type))
     else:
         xx, yy, __, fwhm = centroid
-        actor.writeToUsers('d', 'text="{0}-axis camera centroid detected '
-                                'at ({1:.1f}, {2:.1f}) with fwhm {3:.2f} arcsec"'
-                                .format(camera_type, xx, yy, fwhm))
         actor.centroids[camera_type] = (xx, yy)
-        actor.fwhm[camera_type] = fwhm
+
+        # If the FWHM was not measured for this frame we keep the previous value.
+        if fwhm is None:
+            actor.writeToUsers('d', 'text="{0}-axis camera centroid detected '
+                                    'at ({1:.1f}, {2:.1f})"'.format(camera_type, xx, yy))
+        else:
+            actor.writeToUsers('d', 'text="{0}-axis camera centroid detected '
+                                    'at ({1:.1f}, {2:.1f}) with fwhm {3:.2f} arcsec"'
+                                    .format(camera_type, xx, yy, fwhm))
+            actor.fwhm[camera_type] = fwhm
 
     return True
 
@@ -65,7 +85,10 @@ def create_exposure_path(actor):
     if len(files) == 0:
         last_no = 0
     else:
-        last_no = int(files[-1].split('.')[0].split('-')[-1])
+        last_no = int(os.path.basename(files[-1]).split('.')[0].split('-')[-1])
+
+    last_no = max(last_no, _last_exposure_no.get(dirname, 0))
+    _last_exposure_no[dirname] = last_no + 1
 
     return dirname, 'bimg-{0:04d}.fits'.format(last_no + 1)
 
@@ -114,8 +137,76 @@ def do_expose(actor, cmd, camera_type, one=False, subtract_background=True):
             log.debug('background mean: {0:.3f}'.format(camera.background.background_median),
                       actor)
 
-        # Tries to display the image.
-        display_image(image.data, camera_type, actor, cmd)
+        # Queues the image after the one being processed, if any. This keeps the
+        # frames in order, and since the next exposure is only started when the
+        # processing of this frame begins, at most one frame is left waiting.
+        processing = _processing[camera_type] or defer.succeed(None)
+        processing.addCallback(lambda __: _start_processing(image))
+        processing.addErrback(
+            lambda failure: log.warning('failed to process {0}-axis image: {1}'
+                                        .format(camera_type, failure.getErrorMessage()),
+                                        actor))
+
+        _processing[camera_type] = processing
+
+    def _start_processing(image):
+        """Starts the next exposure and processes the image.
+
+        The centroid is measured in a thread so that the next exposure is
+        taken meanwhile. Returns a deferred that fires once the image has
+        been displayed and saved.
+
+        """
+
+        last_frame = actor.stop_exposure
+        if not last_frame:
+            reactor.callLater(0.1, do_expose, actor, cmd, camera_type, one=False,
+                              subtract_background=subtract_background)
+
+        # Values lower than one mean measuring the FWHM in every frame. The
+        # last frame (or the only one, with --one) always gets a FWHM.
+        fwhm_cadence = max(1, int(actor.config['cameras'].get('fwhm_cadence', FWHM_CADENCE)))
+        measure_fwhm = (last_frame or
+                        _n_frames_displayed[camera_type] % fwhm_cadence == 0)
+        _n_frames_displayed[camera_type] += 1
+
+        centroid_deferred = threads.deferToThread(measure_centroid, image.data,
+                                                  measure_fwhm=measure_fwhm)
+        centroid_deferred.addErrback(_centroid_failed)
+        centroid_deferred.addCallback(_display_and_save, image)
+
+        # The command is only done once the last image has been displayed and saved.
+        if last_frame:
+            centroid_deferred.addBoth(_stop)
+
+        return centroid_deferred
+
+    def _stop(result):
+        """Sets the camera idle and finishes the command."""
+
+        log.info('stopping {0}-axis camera.'.format(camera_type))
+        camera.state = 'idle'
+        if not cmd.isDone:
+            cmd.setState(cmd.Done)
+
+        return result
+
+    def _centroid_failed(failure):
+        """Errback if the centroid cannot be measured. The image is still displayed."""
+
+        log.warning('failed to measure {0}-axis centroid: {1}'
+                    .format(camera_type, failure.getErrorMessage()), actor)
+
+        return None
+
+    def _display_and_save(centroid, image):
+        """Displays the image and centroid, and saves the image to disk.
+
+        Returns a deferred that fires when the image has been written.
+
+        """
+
+        display_image(image.data, centroid, camera_type, actor, cmd)
 
         camera_ra = camera_dec = None
 
@@ -141,19 +232,21 @@ def do_expose(actor, cmd, camera_type, one=False, subtract_background=True):
 
         image.header.extend(extra_header)
 
-        dirname, basename = create_exposure_path(actor)
-        fn = image.save(dirname=dirname, basename=basename, compress=True)
+        # Writes the image in a thread so that the next exposure is not delayed
+        # by the disk I/O. Raw uint16 frames are small enough to save uncompressed, which is
+        # faster. Background-subtracted frames are float64 so we compress them.
+        compress = image.data.dtype.kind == 'f'
 
-        log.debug('saved {0}-axis image {1}'.format(camera_type, fn))
+        dirname, basename = create_exposure_path(actor)
+        save_deferred = threads.deferToThread(image.save, dirname=dirname,
+                                              basename=basename, compress=compress)
+        save_deferred.addCallbacks(
+            lambda fn: log.debug('saved {0}-axis image {1}'.format(camera_type, fn)),
+            lambda failure: log.warning('failed to save {0}-axis image {1}: {2}'
+                                        .format(camera_type, basename,
+                                                failure.getErrorMessage()), actor))
 
-        if not actor.stop_exposure:
-            reactor.callLater(0.1, do_expose, actor, cmd, camera_type, one=False,
-                              subtract_background=subtract_background)
-        else:
-            log.info('stopping {0}-axis camera.'.format(camera_type))
-            camera.state = 'idle'
-            if not cmd.isDone:
-                cmd.setState(cmd.Done)
+        return save_deferred
 
     camera.expose(_process_image)
 
@@ -215,6 +308,7 @@ def expose(actor, cmd, camera_type, background, one=False):
     camera_types = ['on', 'off'] if camera_type == 'all' else [camera_type]
 
     actor.stop_exposure = False  # Resets the trigger
+    _n_frames_displayed.update((ct, 0) for ct in camera_types)  # Restarts the FWHM cadence
 
     for ct in camera_types:
         log.info('starting exposure in {0}-axis camera.'.format(ct))
@@ -59,7 +59,8 @@ def centre_up(actor, cmd, translate, dryrun):
                     .format(ra_offset, dec_offset), actor)
 
         if off_centroid is not None:
-            plate_id = bmo.utils.get_plateid(actor.tccActor.dev_state.instrumentNum)
+            # The plate_id is updated along with the TCC status so we don't need to query it.
+            plate_id = actor.tccActor.dev_state.plate_id
             rot_offset = bmo.utils.get_rotation_offset(plate_id, off_centroid,
                                                        translation_offset=(ra_offset, dec_offset))
             rot_msg = ' (not applying it)' if translate else ''
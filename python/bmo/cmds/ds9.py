@@ -113,7 +113,7 @@ def display_dss(cmd, actor, plate_id, try_server=False):
             display_dss_from_file(actor.ds9, acq_dss_off_path, 'off', plate_id, frame=4)
             return True
 
-    except (BMOError, AssertionError) as ee:
+    except (BMOError, ValueError) as ee:
 
         log.warning('failed to display DSS images from file: {0}'.format(ee), actor)
 
@@ -132,7 +132,7 @@ def display_dss(cmd, actor, plate_id, try_server=False):
 
         try:
             coords = get_camera_coordinates(plate_id, camera=camera)
-        except (BMOError, AssertionError) as ee:
+        except (BMOError, ValueError) as ee:
             log.warning('failed to get {0} camera '
                         'coordinates: {1}"'.format(camera, str(ee)), actor)
             continue
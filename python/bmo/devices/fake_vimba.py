@@ -135,6 +135,10 @@ class Vimba(object):
         """Starts the controller."""
         pass
 
+    def shutdown(self):
+        """Shuts down the controller."""
+        pass
+
     def getSystem(self):
         """Returns an instance of VimbaSystem."""
 
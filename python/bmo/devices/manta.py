@@ -10,11 +10,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import atexit
 import os
 import time
 import warnings
 
-from twisted.internet import task
+from twisted.internet import reactor, task
 
 from distutils.version import StrictVersion
 
@@ -49,6 +50,10 @@ except Exception:
 # These parameters can be overridden by the actor configuration.
 UPDATE_INTERVAL = 3          # How frequently the available cameras will be checked.
 EXTRA_EXPOSURE_DELAY = 1000  # How much extra time to wait for waitFrameCapture (ms).
+BUFFER_COUNT = 7             # How many frames to announce and queue to the camera.
+
+# Template for the basic exposure header. Copied and updated for each exposure.
+_HEADER_TEMPLATE = fits.Header([('EXPTIME', 0.), ('DEVICE', ''), ('OBSTIME', '')])
 
 
 def get_list_devices(config):
@@ -94,9 +99,13 @@ class MantaExposure(object):
         self.hole_ra = None
         self.hole_dec = None
 
-        self.header = fits.Header([('EXPTIME', self.exposure_time),
-                                   ('DEVICE', self.camera_id),
-                                   ('OBSTIME', self.obstime)] + extra_headers)
+        self.header = _HEADER_TEMPLATE.copy()
+        self.header['EXPTIME'] = self.exposure_time
+        self.header['DEVICE'] = self.camera_id
+        self.header['OBSTIME'] = self.obstime
+
+        if extra_headers:
+            self.header.extend(extra_headers)
 
     @property
     def raw(self):
@@ -132,7 +141,8 @@ class MantaExposure(object):
         if value is None:
             self._background = None
         else:
-            assert isinstance(value, Background2D), 'background must be a Background2D object'
+            if not isinstance(value, Background2D):
+                raise ValueError('background must be a Background2D object')
             self._background = value
 
     def subtract_background(self, background=None, sigma_clip=sigma_clip,
@@ -246,7 +256,8 @@ class MantaExposure(object):
 
         # Creates the WCS header and adds it to the primary HDU.
         if wcs is not None:
-            assert isinstance(self.wcs, astropy.wcs.WCS), 'invalid type for wcs.'
+            if not isinstance(wcs, astropy.wcs.WCS):
+                raise ValueError('invalid type for wcs.')
             wcs_header = wcs.to_header()
         else:
             try:
@@ -262,20 +273,20 @@ class MantaExposure(object):
 
         hdu = primary
 
-        if overwrite is False:
-            assert not os.path.exists(fn), \
-                'the path exists. If you want to overwrite it use overwrite=True.'
+        if overwrite is False and os.path.exists(fn):
+            raise ValueError('the path exists. If you want to overwrite it use overwrite=True.')
 
         if compress:
             fn += '.fz'
             hdu = fits.CompImageHDU(data=hdu.data,
                                     header=hdu.header)
 
-        # Depending on the version of astropy, uses clobber or overwrite
+        # Depending on the version of astropy, uses clobber or overwrite. The
+        # header is built by us so we skip the verification and checksum steps.
         if StrictVersion(astropy.__version__) < StrictVersion('1.3.0'):
-            hdu.writeto(fn, clobber=overwrite)
+            hdu.writeto(fn, clobber=overwrite, output_verify='ignore', checksum=False)
         else:
-            hdu.writeto(fn, overwrite=overwrite)
+            hdu.writeto(fn, overwrite=overwrite, output_verify='ignore', checksum=False)
 
         del hdu
 
@@ -341,10 +352,13 @@ class MantaCameraSet(object):
         log.debug('starting MantaCameraSet with vimba={!r}'.format(vimba))
 
         self.system = None
+        self._vimba_running = False
+
+        # Defined before starting Vimba so that close() works if the startup fails.
+        self.cameras = []
 
         self._init_controller()
 
-        self.cameras = []
         self.connect_all()
 
         # Starts the loop that checks whether cameras are connected or disconnected.
@@ -355,6 +369,10 @@ class MantaCameraSet(object):
         """Initialises the camera controller."""
 
         self.vimba.startup()
+        self._vimba_running = True
+
+        # Makes sure the cameras are closed and Vimba is shut down on exit.
+        atexit.register(self.close)
 
         self.system = self.vimba.getSystem()
 
@@ -483,16 +501,35 @@ class MantaCameraSet(object):
     def close(self):
         """Closes the Vimba system."""
 
+        # A failure closing a camera (e.g., writing to the actor after the
+        # reactor has stopped) must not prevent Vimba from shutting down.
         for camera in self.cameras:
-            camera.close()
+            try:
+                if camera.open:
+                    camera.close()
+            except Exception as ee:
+                warnings.warn('failed closing camera {0}: {1}'.format(camera.camera_id, ee),
+                              BMOUserWarning)
 
-        log.info('shutting down the Vimba system.', self.actor)
-        self.vimba.shutdown()
+        # close can be called both from atexit and __del__. Shuts down only once.
+        if not self._vimba_running:
+            return
+
+        try:
+            log.info('shutting down the Vimba system.', self.actor)
+        finally:
+            self.vimba.shutdown()
+            self._vimba_running = False
 
     def __del__(self):
         """Closes the Vimba system if the object is destroyed."""
 
-        self.close()
+        # __del__ may be called during interpreter shutdown, when modules may
+        # already be gone. Ignores any error.
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 class MantaCamera(object):
@@ -527,6 +564,7 @@ class MantaCamera(object):
         self._state = 'idle'
         self.is_busy = False
         self._exposure_cb = None  # The function that will be call when and exposure is done.
+        self._awaiting_frame = False  # Whether we have requested a frame.
 
         self.camera = None
         self._camera_type = None
@@ -540,8 +578,8 @@ class MantaCamera(object):
         """Initialises the camera.
 
         Gets the camera from the Vimba API, opens it, and sets the default
-        configuration. It then creates a frame and announces and queues it
-        to the camera. Finally, starts the capture mode.
+        configuration. It then creates a pool of frames and announces and
+        queues them to the camera. Finally, starts the capture mode.
 
         """
 
@@ -559,15 +597,23 @@ class MantaCamera(object):
 
         self.open = True
         self.camera_id = camera_id
+        self._awaiting_frame = False
 
-        self.frame = self.camera.getFrame()
-        log.debug('got new frame.')
+        # Overrides BUFFER_COUNT from the config file, if possible.
+        if self.actor and 'buffer_count' in self.actor.config['cameras']:
+            buffer_count = self.actor.config['cameras']['buffer_count']
+        else:
+            buffer_count = BUFFER_COUNT
 
-        self.frame.announceFrame()
-        log.debug('announced frame.')
+        # Announces a pool of frames so that the driver always has a buffer
+        # available to write to while we are processing the previous one.
+        self.frames = [self.camera.getFrame() for __ in range(buffer_count)]
+        log.debug('got {0} new frames.'.format(buffer_count))
 
-        self.frame.queueFrameCapture(self.frame_callback)
-        log.debug('queued frame.')
+        for frame in self.frames:
+            frame.announceFrame()
+            frame.queueFrameCapture(self.frame_callback)
+        log.debug('announced and queued frames.')
 
         self.camera.startCapture()
         log.debug('starting camera capture.')
@@ -586,7 +632,7 @@ class MantaCamera(object):
 
         self.camera.PixelFormat = 'Mono12'
         self.camera.ExposureTimeAbs = 1e6
-        self.camera.AcquisionMode = 'SingleFrame'
+        self.camera.AcquisitionMode = 'SingleFrame'
         self.camera.GVSPPacketSize = 1500
         self.camera.GevSCPSPacketSize = 1500
 
@@ -605,6 +651,8 @@ class MantaCamera(object):
 
         log.debug('starting exposure.', actor=False)
 
+        self._awaiting_frame = True
+
         self.camera.runFeatureCommand('AcquisitionStart')
         self.camera.runFeatureCommand('AcquisitionStop')
 
@@ -617,28 +665,43 @@ class MantaCamera(object):
 
         If ``MantaCamera.exposure`` has been called with a ``call_back_func``,
         it calls that function and passes it the ``MantaExposure`` object.
+        This method runs in a Vimba thread, so the callback is scheduled in
+        the reactor thread.
 
         """
 
         # log.debug('frame callback called. Processing image.')
 
+        # Discards any frame that we have not requested (e.g., stale frames
+        # left in the queue) so that the exposure callback gets a fresh one.
+        if not self._awaiting_frame:
+            log.debug('discarding unrequested frame.', actor=False)
+            frame.queueFrameCapture(self.frame_callback)
+            return
+
+        self._awaiting_frame = False
+
         img_buffer = frame.getBufferByteData()
         img_data_array = np.ndarray(buffer=img_buffer,
                                     dtype=np.uint16,
                                     shape=(frame.height, frame.width))
 
-        self._last_exposure = MantaExposure(img_data_array,
+        # The array is a view on the Vimba buffer, which is reused as soon as the
+        # frame is requeued. A single in-memory copy detaches the data from it.
+        data = np.array(img_data_array, copy=True)
+
+        self._last_exposure = MantaExposure(data,
                                             self.camera.ExposureTimeAbs / 1e6,
                                             self.camera.cameraIdString)
 
-        self.frame.queueFrameCapture(self.frame_callback)
+        frame.queueFrameCapture(self.frame_callback)
         # log.debug('requeued frame.')
 
         self.is_busy = False
 
         if self._exposure_cb is not None:
             # log.debug('calling exposure callback function.')
-            self._exposure_cb(self._last_exposure)
+            reactor.callFromThread(self._exposure_cb, self._last_exposure)
 
         return
 
@@ -656,8 +719,8 @@ class MantaCamera(object):
 
         """
 
-        assert exposure is not None or self._last_exposure is not None, \
-            'no exposure provided. Take an exposure before calling save.'
+        if exposure is None and self._last_exposure is None:
+            raise MantaError('no exposure provided. Take an exposure before calling save.')
 
         exposure = exposure or self._last_exposure
         exposure.save(fn, **kwargs)
@@ -678,7 +741,8 @@ class MantaCamera(object):
     def state(self, value):
         """Sets the state of the camera and updated keywords."""
 
-        assert value in ['exposing', 'idle']
+        if value not in ['exposing', 'idle']:
+            raise ValueError('invalid camera state {0!r}'.format(value))
         self._state = value
 
         if self.camera_set is not None and self.camera_set.actor is not None:
@@ -716,8 +780,7 @@ class MantaCamera(object):
             self.camera.endCapture()
             self.camera.revokeAllFrames()
             self.camera.closeCamera()
-            # self.vimba.shutdown()
-        except self.controller.VimbaException as ee:
+        except Exception as ee:
             warnings.warn('failed closing the camera. Error: {0}'.format(str(ee)), BMOUserWarning)
 
         if self.actor:
@@ -731,5 +794,8 @@ class MantaCamera(object):
     def __del__(self):
         """Destructor."""
 
-        if self.open:
-            self.close()
+        try:
+            if getattr(self, 'open', False):
+                self.close()
+        except Exception:
+            pass
@@ -15,6 +15,10 @@ class BMOError(Exception):
     """Base exception for BMO. Other exceptions should inherit this."""
 
 
+class NoCentroidError(BMOError):
+    """No centroid was found in the image."""
+
+
 class MantaError(Exception):
     """Manta camera error."""
 
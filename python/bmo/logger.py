@@ -202,7 +202,7 @@ class MyLogger(Logger):
         mod_name = None
         mod_path, ext = os.path.splitext(mod_path)
         for name, mod in sys.modules.items():
-            path = os.path.splitext(getattr(mod, '__file__', ''))[0]
+            path = os.path.splitext(getattr(mod, '__file__', None) or '')[0]
             if path == mod_path:
                 mod_name = mod.__name__
                 break
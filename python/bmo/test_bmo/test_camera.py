@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# test_camera.py
+#
+# Created by José Sánchez-Gallego on 15 Oct 2026.
+
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import bmo.cmds.camera
+from bmo.utils import get_sjd
+
+
+class FakeActor(object):
+    """A fake actor with only the configuration needed to create paths."""
+
+    def __init__(self, save_path):
+
+        self.config = {'cameras': {'save_path': save_path}}
+
+
+class TestCreateExposurePath(TestCase):
+
+    def setUp(self):
+
+        self.save_path = tempfile.mkdtemp()
+        self.actor = FakeActor(self.save_path)
+        self.dirname = os.path.join(self.save_path, str(get_sjd()))
+
+        bmo.cmds.camera._last_exposure_no.clear()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.save_path)
+        bmo.cmds.camera._last_exposure_no.clear()
+
+    def _touch(self, basename):
+
+        open(os.path.join(self.dirname, basename), 'w').close()
+
+    def test_empty_directory(self):
+
+        dirname, basename = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(dirname, self.dirname)
+        self.assertTrue(os.path.exists(dirname))
+        self.assertEqual(basename, 'bimg-0001.fits')
+
+    def test_existing_files(self):
+
+        os.makedirs(self.dirname)
+        self._touch('bimg-0001.fits')
+        self._touch('bimg-0002.fits.fz')
+
+        __, basename = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(basename, 'bimg-0003.fits')
+
+    def test_pending_write(self):
+
+        # The first image has not been written when the second path is requested.
+        __, basename_1 = bmo.cmds.camera.create_exposure_path(self.actor)
+        __, basename_2 = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(basename_1, 'bimg-0001.fits')
+        self.assertEqual(basename_2, 'bimg-0002.fits')
+
+    def test_pending_write_and_existing_files(self):
+
+        __, basename_1 = bmo.cmds.camera.create_exposure_path(self.actor)
+        self._touch(basename_1)
+
+        __, basename_2 = bmo.cmds.camera.create_exposure_path(self.actor)
+        __, basename_3 = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(basename_2, 'bimg-0002.fits')
+        self.assertEqual(basename_3, 'bimg-0003.fits')
+
+        # Files written by another process are also taken into account.
+        self._touch('bimg-0010.fits')
+        __, basename_4 = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(basename_4, 'bimg-0011.fits')
+
+    def test_dots_in_save_path(self):
+
+        self.actor.config['cameras']['save_path'] = os.path.join(self.save_path, 'data.bcam')
+        dirname, __ = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        open(os.path.join(dirname, 'bimg-0005.fits'), 'w').close()
+        bmo.cmds.camera._last_exposure_no.clear()
+
+        __, basename = bmo.cmds.camera.create_exposure_path(self.actor)
+
+        self.assertEqual(basename, 'bimg-0006.fits')
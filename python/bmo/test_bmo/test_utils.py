@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# test_utils.py
+#
+# Created by José Sánchez-Gallego on 15 Oct 2026.
+
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+import numpy as np
+
+import bmo.utils
+
+
+class TestMemoize(TestCase):
+
+    def setUp(self):
+
+        self.calls = []
+
+        @bmo.utils.memoize
+        def add(aa, bb=0):
+            self.calls.append((aa, bb))
+            if aa < 0:
+                raise ValueError('negative value')
+            return aa + bb
+
+        self.add = add
+
+    def test_cache_hit(self):
+
+        self.assertEqual(self.add(1, bb=2), 3)
+        self.assertEqual(self.add(1, bb=2), 3)
+        self.assertEqual(self.calls, [(1, 2)])
+
+    def test_different_arguments(self):
+
+        self.assertEqual(self.add(1), 1)
+        self.assertEqual(self.add(1, bb=2), 3)
+        self.assertEqual(self.calls, [(1, 0), (1, 2)])
+
+    def test_exceptions_not_cached(self):
+
+        with self.assertRaises(ValueError):
+            self.add(-1)
+
+        with self.assertRaises(ValueError):
+            self.add(-1)
+
+        self.assertEqual(self.calls, [(-1, 0), (-1, 0)])
+
+    def test_cache_clear(self):
+
+        self.add(1)
+        self.add.cache_clear()
+        self.add(1)
+
+        self.assertEqual(self.calls, [(1, 0), (1, 0)])
+
+    def test_wraps(self):
+
+        self.assertEqual(self.add.__name__, 'add')
+
+
+def _get_angle_numpy(x_focal, y_focal):
+    """The original numpy implementation of ``get_angle``, for comparison."""
+
+    x_focal_rad = np.deg2rad(x_focal * bmo.utils.FOCAL_SCALE / 3600)
+    y_focal_rad = np.deg2rad(y_focal * bmo.utils.FOCAL_SCALE / 3600)
+
+    cc = np.arccos(np.cos(x_focal_rad) * np.cos(y_focal_rad))
+    theta = np.rad2deg(np.arccos(np.tan(np.pi / 2. - cc) * np.tan(y_focal_rad)))
+
+    if x_focal >= 0:
+        return theta
+    else:
+        return 360 - theta
+
+
+class TestGetAngle(TestCase):
+
+    def test_quadrants(self):
+
+        for x_focal, y_focal in [(100., 200.), (-100., 200.), (-100., -200.),
+                                 (100., -200.), (300., 0.), (-300., 0.)]:
+            self.assertAlmostEqual(bmo.utils._get_angle(x_focal, y_focal),
+                                   _get_angle_numpy(x_focal, y_focal))
+
+    def test_acos_limit(self):
+
+        # On the y axis the acos argument is +/-1 within rounding. The numpy
+        # version returns NaN there; the argument is now clipped.
+        self.assertTrue(np.isnan(_get_angle_numpy(0., 150.)))
+
+        self.assertAlmostEqual(bmo.utils._get_angle(0., 150.), 0.)
+        self.assertAlmostEqual(bmo.utils._get_angle(0., -150.), 180.)
+        self.assertAlmostEqual(bmo.utils._get_angle(-1e-6, -150.), 180.)
+
+
+class TestGetTranslationOffset(TestCase):
+
+    scale = bmo.utils.PIXEL_SIZE * bmo.utils.FOCAL_SCALE
+
+    def test_default_shape(self):
+
+        width, height = bmo.utils.DEFAULT_IMAGE_SHAPE
+
+        trans_ra, trans_dec = bmo.utils.get_translation_offset((1000., 500.))
+
+        self.assertAlmostEqual(trans_ra, (1000. - width / 2.) * self.scale)
+        self.assertAlmostEqual(trans_dec, (500. - height / 2.) * self.scale)
+
+    def test_image_centre(self):
+
+        trans_ra, trans_dec = bmo.utils.get_translation_offset((1000., 500.),
+                                                               img_centre=(900, 700))
+
+        self.assertAlmostEqual(trans_ra, 100. * self.scale)
+        self.assertAlmostEqual(trans_dec, -200. * self.scale)
+
+    def test_centred(self):
+
+        self.assertEqual(bmo.utils.get_translation_offset((10, 20), img_centre=(10, 20)),
+                         (0., 0.))
+
+
+class FakeDS9(object):
+    """A fake DS9 connection that returns predefined values."""
+
+    def __init__(self, values):
+
+        self.values = values
+
+    def set(self, *args):
+
+        pass
+
+    def get(self, param):
+
+        return self.values[param]
+
+
+class TestReadDS9Regions(TestCase):
+
+    regions = ('# Region file format: DS9 version 4.1\n'
+               'global color=green dashlist=8 3 width=1\n'
+               'image\n'
+               'circle(1752.42,454.107,29) # color=green\n'
+               'text(1752.42,513.107) text={1.23} color=green\n'
+               'point(968,608) # point=cross 20 color=blue\n')
+
+    def test_circle_regex(self):
+
+        match = bmo.utils._CIRCLE_RE.search(self.regions)
+
+        self.assertIsNotNone(match)
+        self.assertEqual(match.groups()[0], '1752.42,454.107,29')
+
+    def test_read_ds9_regions(self):
+
+        ds9 = FakeDS9({'regions -format ds9 -system image': self.regions,
+                       'fits height': '1216',
+                       'fits width': '1936'})
+
+        result, (xx, yy, width, height) = bmo.utils.read_ds9_regions(ds9)
+
+        self.assertTrue(result)
+        self.assertAlmostEqual(xx, 1752.42)
+        self.assertAlmostEqual(yy, 454.107)
+        self.assertEqual(width, 1936)
+        self.assertEqual(height, 1216)
+
+    def test_no_circle(self):
+
+        ds9 = FakeDS9({'regions -format ds9 -system image': 'image\npoint(968,608)\n'})
+
+        result, message = bmo.utils.read_ds9_regions(ds9)
+
+        self.assertFalse(result)
+        self.assertIn('no circle regions', message)
@@ -10,16 +10,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import functools
+import math
 import numpy as np
 import os
 import re
 import warnings
 
+from astropy.io import fits
 from astropy.wcs import WCS
 import astropy.time as time
 
 from bmo import pathlib, config
-from bmo.exceptions import BMOError, BMOUserWarning
+from bmo.exceptions import BMOError, BMOUserWarning, NoCentroidError
 
 try:
     from sdssdb.observatory import database, platedb
@@ -40,20 +43,47 @@ except ImportError:
 
 __all__ = ('FOCAL_SCALE', 'PIXEL_SIZE', 'get_centroid', 'get_plateid',
            'get_camera_focal', 'get_translation_offset', 'get_rotation_offset',
-           'show_in_ds9', 'read_ds9_regions', 'get_camera_coordinates', 'get_sjd',
-           'get_acquisition_dss_path')
+           'measure_centroid', 'display_in_ds9', 'show_in_ds9', 'read_ds9_regions',
+           'get_camera_coordinates', 'get_sjd', 'get_acquisition_dss_path',
+           'prefetch_plate_data')
 
 FOCAL_SCALE = config['telescope']['focal_scale']
 PIXEL_SIZE = config['cameras']['pixel_scale']
 
 DEFAULT_IMAGE_SHAPE = config['cameras']['image_shape']
 
+# Matches the arguments of a DS9 circle region.
+_CIRCLE_RE = re.compile(r'circle\(([^)]*)\)')
+
 
 # Makes sure database points to the right DB profile
 if database:
     database.connect_from_config(config['DB']['profile'])
 
 
+def memoize(function):
+    """Caches the return value of a function for each set of arguments.
+
+    Meant for functions whose output only depends on the plate and camera
+    and that are called repeatedly during a night. Exceptions are not cached.
+    The cache can be reset with ``function.cache_clear()``.
+
+    """
+
+    cache = {}
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = function(*args, **kwargs)
+        return cache[key]
+
+    wrapper.cache_clear = cache.clear
+
+    return wrapper
+
+
 def get_plateid(cartID):
     """Gets the plateID for a certain cartID."""
 
@@ -67,11 +97,15 @@ def get_plateid(cartID):
         platedb.ActivePlugging).where(platedb.ActivePlugging.pk == cartID).scalar()
 
 
+@memoize
 def get_acquisition_dss_path(plate_id, camera='center'):
     """Returns the path for the acquisition camera DSS image in platelist."""
 
-    assert os.environ['PLATELIST_DIR'] != '', 'platelist is not set.'
-    assert camera in ['center', 'offaxis'], 'invalid camera type.'
+    if camera not in ['center', 'offaxis']:
+        raise ValueError('invalid camera type.')
+
+    if os.environ.get('PLATELIST_DIR', '') == '':
+        raise BMOError('platelist is not set.')
 
     plate6 = str(plate_id).zfill(6)
     plate6XX = plate6[0:4] + 'XX'
@@ -83,10 +117,12 @@ def get_acquisition_dss_path(plate_id, camera='center'):
     return dss_path
 
 
+@memoize
 def get_camera_coordinates(plate_id, camera='center'):
     """Returns the RA/Dec coordinates for a camera."""
 
-    assert camera in ['center', 'offaxis'], 'invalid camera type.'
+    if camera not in ['center', 'offaxis']:
+        raise ValueError('invalid camera type.')
 
     if database.check_connection() is False:
         raise BMOError('no database is available.')
@@ -109,18 +145,22 @@ def get_camera_coordinates(plate_id, camera='center'):
         # and convert it to RA/Dec, but that requires rewriting xy2ad in Python.
 
         off_path = get_acquisition_dss_path(plate_id, camera='offaxis')
-        assert off_path.exists(), 'off axis acquisition camera DSS image does not exist.'
+        if not off_path.exists():
+            raise BMOError('off axis acquisition camera DSS image does not exist.')
 
-        wcs = WCS(str(off_path))
+        # We only need the header to build the WCS, so we don't touch the data.
+        wcs = WCS(fits.getheader(str(off_path)))
         footprint = wcs.calc_footprint()
 
         return (footprint[:, 0].mean(), footprint[:, 1].mean())
 
 
+@memoize
 def get_camera_focal(plate_id, camera='center'):
     """Returns the xyfocal coordinates for a camera."""
 
-    assert camera in ['center', 'offaxis'], 'invalid camera type.'
+    if camera not in ['center', 'offaxis']:
+        raise ValueError('invalid camera type.')
 
     hole_type = 'ACQUISITION_{0}'.format(camera.upper())
 
@@ -128,30 +168,63 @@ def get_camera_focal(plate_id, camera='center'):
         platedb.PlateHole).join(platedb.PlateHolesFile).join(platedb.Plate).where(
             (platedb.Plate.plate_id == plate_id) & (platedb.PlateHoleType.label == hole_type))
 
-    assert query.count() == 1, 'incorrect number of returned holes.'
+    # Retrieves the holes in a single round-trip instead of calling count() and first().
+    holes = list(query.limit(2))
+    if len(holes) != 1:
+        raise BMOError('incorrect number of returned holes.')
 
-    hole = query.first()
+    hole = holes[0]
 
     return (float(hole.xfocal), float(hole.yfocal))
 
 
+def prefetch_plate_data(plate_id):
+    """Caches the camera coordinates and xyFocal for a newly loaded plate.
+
+    Meant to be called when the plate changes, so that the DB queries and DSS
+    parsing happen once, and not during centring or while exposing.
+    Returns a list of errors found while retrieving the data.
+
+    """
+
+    errors = []
+
+    for camera in ['center', 'offaxis']:
+        for function in [get_camera_coordinates, get_camera_focal]:
+            try:
+                function(plate_id, camera=camera)
+            except Exception as ee:
+                errors.append('{0}({1}, {2!r}): {3}'.format(function.__name__, plate_id,
+                                                            camera, ee))
+
+    return errors
+
+
 def get_centroid(image, return_fwhm=False):
     """Uses PyGuide to return the brightest centroid in an array."""
 
     if PyGuide is None:
         raise BMOError('PyGuide cannot be imported.')
 
-    mask = np.zeros(image.shape, dtype=np.bool)
+    # PyGuide accepts mask=None, which avoids allocating a full-frame boolean
+    # array on each call. If we need to mask part of the image (e.g., the weird
+    # illumination pattern at mask[:, 1900:]) we should create the mask here.
+    mask = None
 
-    # Masking to the right part of the image until we understand the origin of
-    # the weird illumination pattern.
-    # mask[:, 1900:] = 1
+    # The sky background is robust to subsampling, so we estimate the median
+    # from a 4x4 grid of pixels (1/16 of the frame) using a partial sort. A
+    # flat stride of 16 would sample the same columns in every row.
+    background_sample = image[::4, ::4].ravel()
+    kk = background_sample.size // 2
+    # Cast to float, as np.median did. A uint16 value would make image - bias wrap around.
+    background = float(np.partition(background_sample, kk)[kk])
 
-    ccdInfo = PyGuide.CCDInfo(np.median(image), 5, 5)
+    ccdInfo = PyGuide.CCDInfo(background, 5, 5)
     stars = PyGuide.findStars(image, mask, None, ccdInfo)
 
     centroids = stars[0]
-    assert len(centroids) > 0, 'no centroids found.'
+    if len(centroids) == 0:
+        raise NoCentroidError('no centroids found.')
 
     if not return_fwhm:
         return centroids[0]
@@ -167,6 +240,30 @@ def get_centroid(image, return_fwhm=False):
     return (centroids[0], fwhm)
 
 
+def _get_angle(x_focal, y_focal):
+    """Returns the angle from the centre of the plate.
+
+    Both inputs are scalars so we use `math` instead of numpy, avoiding the
+    overhead of creating arrays for each operation.
+
+    """
+
+    x_focal_rad = math.radians(x_focal * FOCAL_SCALE / 3600.)
+    y_focal_rad = math.radians(y_focal * FOCAL_SCALE / 3600.)
+
+    cc = math.acos(math.cos(x_focal_rad) * math.cos(y_focal_rad))
+
+    # Clips the argument to avoid math domain errors due to rounding.
+    cos_theta = min(max(math.tan(math.pi / 2. - cc) * math.tan(y_focal_rad), -1.), 1.)
+    theta = math.degrees(math.acos(cos_theta))
+
+    # acos always returns 0 to 180. Depending on the quadrant we return the correct value.
+    if x_focal >= 0:
+        return theta
+    else:
+        return 360 - theta
+
+
 def get_translation_offset(centroid, shape=DEFAULT_IMAGE_SHAPE, img_centre=None):
     """Calculates the offset from the centre of the image to the centroid.
 
@@ -193,14 +290,16 @@ def get_translation_offset(centroid, shape=DEFAULT_IMAGE_SHAPE, img_centre=None)
 
     """
 
+    # We work with scalars. For two elements numpy only adds overhead.
     if img_centre is None:
-        on_centre = np.array([shape[0] / 2., shape[1] / 2.])
+        x_centre, y_centre = shape[0] / 2., shape[1] / 2.
     else:
-        on_centre = np.array(img_centre, dtype=np.float)
+        x_centre, y_centre = float(img_centre[0]), float(img_centre[1])
 
-    on_centroid = np.array(centroid)
+    scale = PIXEL_SIZE * FOCAL_SCALE
 
-    trans_ra, trans_dec = (on_centroid - on_centre) * PIXEL_SIZE * FOCAL_SCALE
+    trans_ra = (centroid[0] - x_centre) * scale
+    trans_dec = (centroid[1] - y_centre) * scale
 
     return trans_ra, trans_dec
 
@@ -240,23 +339,7 @@ def get_rotation_offset(plate_id, centroid, shape=DEFAULT_IMAGE_SHAPE,
 
     """
 
-    def get_angle(x_focal, y_focal):
-        """Returns the angle from the centre of the plate."""
-
-        x_focal_rad = np.deg2rad(x_focal * FOCAL_SCALE / 3600)
-        y_focal_rad = np.deg2rad(y_focal * FOCAL_SCALE / 3600)
-
-        cc = np.arccos(np.cos(x_focal_rad) * np.cos(y_focal_rad))
-        theta = np.rad2deg(np.arccos(np.tan(np.pi / 2. - cc) * np.tan(y_focal_rad)))
-
-        # arccos always returns 0 to 180. Depending on the quadrant we return the correct value.
-        if x_focal >= 0:
-            return theta
-        else:
-            return 360 - theta
-
-    centroid = np.array(centroid)
-    shape = np.array(shape)
+    x_centroid, y_centroid = float(centroid[0]), float(centroid[1])
 
     xy_focal = get_camera_focal(plate_id, camera='offaxis')
     if not xy_focal:
@@ -265,37 +348,76 @@ def get_rotation_offset(plate_id, centroid, shape=DEFAULT_IMAGE_SHAPE,
     else:
         x_focal_centre, y_focal_centre = xy_focal
 
-    angle_centre = get_angle(x_focal_centre, y_focal_centre)
+    angle_centre = _get_angle(x_focal_centre, y_focal_centre)
 
     if translation_offset:
-        translation_offset_pix = np.array(translation_offset) / FOCAL_SCALE / PIXEL_SIZE
-        centroid -= translation_offset_pix
+        x_centroid -= translation_offset[0] / FOCAL_SCALE / PIXEL_SIZE
+        y_centroid -= translation_offset[1] / FOCAL_SCALE / PIXEL_SIZE
 
     # Calculates the x/yFocal of the centroid.
 
     if img_centre is None:
-        img_centre = shape / 2.
+        x_centre, y_centre = shape[0] / 2., shape[1] / 2.
     else:
-        img_centre = np.array(img_centre, dtype=np.float)
+        x_centre, y_centre = float(img_centre[0]), float(img_centre[1])
 
-    x_pix, y_pix = centroid - img_centre
+    x_pix = x_centroid - x_centre
+    y_pix = y_centroid - y_centre
 
     x_focal_off = x_focal_centre - x_pix * PIXEL_SIZE
     y_focal_off = y_focal_centre - y_pix * PIXEL_SIZE
 
-    angle_off = get_angle(x_focal_off, y_focal_off)
+    angle_off = _get_angle(x_focal_off, y_focal_off)
 
     rotation = (angle_off - angle_centre) * 3600
 
     return rotation
 
 
-def show_in_ds9(image, frame=1, ds9=None, zoom=None):
-    """Displays an image in DS9, calculating star centroids.
+def measure_centroid(image, measure_fwhm=True):
+    """Measures the brightest centroid in an image.
+
+    This function does not talk to DS9 so it can be run in a thread.
+
+    Parameters:
+        image (Numpy ndarray):
+            A Numpy ndarray containing the image.
+        measure_fwhm (bool):
+            If ``True``, measures the FWHM of the centroid. Measuring the FWHM
+            requires a float copy of the image so it can be skipped for frames
+            where it is not needed.
+
+    Returns:
+        result (None or tuple):
+            If no centroid has been found for the image, returns ``None``.
+            Otherwise, returns a tuple with the x, y position of the centroid,
+            the radius, as detected by PyGuide, and the FWHM (``None`` if
+            ``measure_fwhm=False``).
+
+    """
+
+    try:
+        if measure_fwhm:
+            centroid, fwhm = get_centroid(image, return_fwhm=True)
+        else:
+            centroid, fwhm = get_centroid(image), None
+    except NoCentroidError:
+        return None
+
+    xx, yy = centroid.xyCtr
+
+    return (xx, yy, centroid.rad, fwhm)
+
+
+def display_in_ds9(image, centroid=None, frame=1, ds9=None, zoom=None):
+    """Displays an image and, optionally, its centroid in DS9.
 
     Parameters:
         image (Numpy ndarray):
             A Numpy ndarray containing the image to display.
+        centroid (tuple or None):
+            The centroid to display, as returned by `.measure_centroid`. If
+            ``None``, only the image and its centre are displayed.
         frame (int):
             The frame in which the image will be displayed.
         ds9 (pyds9 object or None or str):
@@ -306,19 +428,6 @@ def show_in_ds9(image, frame=1, ds9=None, zoom=None):
             The zoom value to set. If ``zoom=None`` and the zoom of the frame
             is 1, the zoom will be set to fit. Otherwise it keep the same zoom.
 
-    Returns:
-        result (None or tuple):
-            If no centroid has been found for the image, returns ``None``.
-            Otherwise, returns a tuple with the x, y position of the centroid,
-            and the radius, as detected by PyGuide.
-
-    Example:
-        Opens a FITS file and displays it
-          >>> data = fits.getdata('image.fits')
-          >>> centroid = show_in_ds9(data, 'on_axis')
-          >>> print(centroid)
-          >>> (19.2, 145.1, 5.1)
-
     """
 
     if not isinstance(ds9, pyds9.DS9):
@@ -329,13 +438,6 @@ def show_in_ds9(image, frame=1, ds9=None, zoom=None):
         else:
             raise ValueError('incorrect value for ds9 keyword: {0!r}'.format(ds9))
 
-    try:
-        centroid, fwhm = get_centroid(image, return_fwhm=True)
-        xx, yy = centroid.xyCtr
-        rad = centroid.rad
-    except AssertionError:
-        centroid = None
-
     ds9.set('frame {0}'.format(frame))
     ds9.set_np2arr(image)
 
@@ -347,16 +449,56 @@ def show_in_ds9(image, frame=1, ds9=None, zoom=None):
         if current_zoom == 1:
             ds9.set('zoom to fit')
 
-    ds9.set('regions command {{point({0}, {1}) # point=cross 20, color=blue}}'.format(
-        image.shape[1] / 2., image.shape[0] / 2.))
+    # Builds all the regions and sends them to DS9 in a single call.
+    regions = ['image',
+               'point({0}, {1}) # point=cross 20 color=blue'.format(image.shape[1] / 2.,
+                                                                    image.shape[0] / 2.)]
 
     if centroid:
-        ds9.set('regions command {{circle({0}, {1}, {2}) # color=green}}'.format(xx, yy, rad))
-        ds9.set('regions command {{text({0}, {1}) # text="{2:.2f}" color=green}}'
-                .format(xx, yy + rad + 30, fwhm if fwhm else 0.0))
-        return (xx, yy, rad, fwhm)
+        xx, yy, rad, fwhm = centroid
+        regions.append('circle({0}, {1}, {2}) # color=green'.format(xx, yy, rad))
+        if fwhm is not None:
+            regions.append('text({0}, {1}) # text="{2:.2f}" color=green'
+                           .format(xx, yy + rad + 30, fwhm))
+
+    ds9.set('regions', '\n'.join(regions))
+
+
+def show_in_ds9(image, frame=1, ds9=None, zoom=None, measure_fwhm=True):
+    """Displays an image in DS9, calculating star centroids.
+
+    Parameters:
+        image (Numpy ndarray):
+            A Numpy ndarray containing the image to display.
+        frame (int):
+            The frame in which the image will be displayed.
+        ds9 (pyds9 object or None or str):
+            Either a ``pyds9`` object used to communicate with DS9, a string to
+            be used to create such a connection, or ``None``. In the latter
+            case ``pyds9.DS9`` will be called without arguments.
+        zoom (int or None):
+            The zoom value to set. If ``zoom=None`` and the zoom of the frame
+            is 1, the zoom will be set to fit. Otherwise it keep the same zoom.
+        measure_fwhm (bool):
+            If ``True``, measures the FWHM of the centroid and displays it.
+
+    Returns:
+        result (None or tuple):
+            The centroid, as returned by `.measure_centroid`.
+
+    Example:
+        Opens a FITS file and displays it
+          >>> data = fits.getdata('image.fits')
+          >>> centroid = show_in_ds9(data, 'on_axis')
+          >>> print(centroid)
+          >>> (19.2, 145.1, 5.1, 1.2)
+
+    """
+
+    centroid = measure_centroid(image, measure_fwhm=measure_fwhm)
+    display_in_ds9(image, centroid=centroid, frame=frame, ds9=ds9, zoom=zoom)
 
-    return None
+    return centroid
 
 
 def read_ds9_regions(ds9, frame=1):
@@ -371,7 +513,7 @@ def read_ds9_regions(ds9, frame=1):
     elif n_circles > 1:
         return False, 'multiple circle regions detected in frame {0}'.format(frame)
 
-    circle_match = re.match('.*circle\((.*)\)', regions, re.DOTALL)
+    circle_match = _CIRCLE_RE.search(regions)
 
     if circle_match is None:
         return False, 'cannot parse region in frame {0}'.format(frame)
@@ -396,7 +538,8 @@ def get_sjd(datetime=None):
     if datetime is None:
         mjd = time.Time.now().mjd
     else:
-        assert isinstance(datetime, time.Time)
+        if not isinstance(datetime, time.Time):
+            raise ValueError('datetime must be an astropy.time.Time object.')
         mjd = datetime.mjd
 
     return int(mjd + 0.4)